@@ -18,9 +18,11 @@ Worlds, Inc.
  *==LICENSE==* """
 
 import argparse
+import functools
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageOps, ImageDraw, ImageFont
-from matplotlib import font_manager
 
 
 # Constants
@@ -50,6 +52,8 @@ DIALOG_AREA_COLOR = (
 ZONE_BORDER_SIZE = (
     10  # In diagnostics mode, render the aspect ratio safe zones with a 10px border.
 )
+DIAGNOSTIC_FONT_FILE = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono-Bold.ttf"  # Preferred diagnostic text font.
+DIAGNOSTIC_FONT_SIZE = 18  # In diagnostics mode, render the diagnostic text at 18pt.
 
 # Structure containing aspect ratios to show as safe zones in the diagnostic image.
 ASPECT_RATIOS = {
@@ -60,118 +64,219 @@ ASPECT_RATIOS = {
 }
 
 
-def draw_diagnostic_text(image, text):
+def get_aspect_ratio_zones(canvas_size):
+    """Calculates the safe zone rectangles for each of our aspect ratios.
+
+    Each zone covers the full height of the canvas and is centered horizontally.
+
+    Args:
+        canvas_size: The (width, height) size of the canvas the zones are drawn onto.
+
+    Returns:
+        A list of (ratio name, zone box, diagnostic color) tuples, one per aspect ratio.
+    """
+
+    canvas_width, canvas_height = canvas_size
+    aspect_zones = []
+
+    for ratio_name, ratio_specs in ASPECT_RATIOS.items():
+        # Calculate the real size of the area covered by the ratio, and the horizontal offset needed to center it
+        zone_width = round(
+            (canvas_height / ratio_specs["height"]) * ratio_specs["width"]
+        )
+        h_offset = round((canvas_width / 2) - (zone_width / 2))
+
+        aspect_zones.append(
+            (
+                ratio_name,
+                ((h_offset, 0), (h_offset + zone_width - 1, canvas_height - 1)),
+                ratio_specs["diag_color"],
+            )
+        )
+
+    return aspect_zones
+
+
+# The safe zone rectangles for each aspect ratio, precomputed for our canvas size.
+ASPECT_ZONES = get_aspect_ratio_zones(CANVAS_SIZE)
+
+# Encoder options to use when saving images, by image format. JPEGs use 4:2:0 chroma subsampling and skip the extra
+# Huffman optimization pass, and PNGs use fast compression.
+SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "subsampling": 2, "optimize": False, "progressive": False},
+    "PNG": {"compress_level": 1},
+}
+
+
+@functools.lru_cache(maxsize=1)
+def get_diagnostic_font():
+    """Loads the font used for diagnostic text.
+
+    The font is only resolved once and reused for every diagnostic draw, as searching the system fonts is slow.
+
+    Returns:
+        The PIL.ImageFont object to draw diagnostic text with.
+    """
+
+    # Prefer a well-known font file, and only fall back to Mathplotlib's font manager to find a sensible font on the
+    # system if it is missing.
+    if os.path.isfile(DIAGNOSTIC_FONT_FILE):
+        return ImageFont.truetype(DIAGNOSTIC_FONT_FILE, DIAGNOSTIC_FONT_SIZE)
+
+    # Mathplotlib is slow to import, so only import it when it is actually needed.
+    try:
+        from matplotlib import font_manager
+    except ImportError:
+        logging.debug(
+            "Mathplotlib is not installed, using the default font for diagnostic text"
+        )
+    else:
+        font = font_manager.FontProperties(family="monospace", weight="bold")
+        return ImageFont.truetype(font_manager.findfont(font), DIAGNOSTIC_FONT_SIZE)
+
+    # Without Mathplotlib, use Pillow's default font.
+    return ImageFont.load_default()
+
+
+def draw_diagnostic_text(diagnostic_draw, position, text):
     """Draws diagnostic text on the diagnostic image.
 
     Args:
-        image: The PIL.Image object to draw the text on.
+        diagnostic_draw: The PIL.ImageDraw context of the diagnostic image to draw the text with.
+        position: The (x, y) coordinates of the top-left corner of the zone the text describes.
         text: The diagnostic text to write to the Image.
     """
 
-    # Use Mathplotlib's font manager to find a sensible font on the system
-    font = font_manager.FontProperties(family="monospace", weight="bold")
-    font_file = font_manager.findfont(font)
-
-    # Use the selected font and write draw the text to the image.
-    fnt = ImageFont.truetype(font_file, 18)
-    d = ImageDraw.Draw(image)
-    d.text((10, 10), text, font=fnt)
+    # Use the selected font and write draw the text to the image, inset from the zone's corner.
+    diagnostic_draw.text(
+        (position[0] + 10, position[1] + 10), text, font=get_diagnostic_font()
+    )
 
 
-def draw_dialog_zone(working_canvas):
+def draw_dialog_zone(working_canvas, diagnostic_draw):
     """Draws a solid rectangle on the diagnostic image showing the area covered by the 'Explorers' dialog.
 
     Args:
         working_canvas: The global PIL.Image canvas to draw the dialog rectangle onto.
+        diagnostic_draw: The PIL.ImageDraw context of the canvas, in RGBA blending mode.
     """
 
     # Calculate the dimensions of the dialog.
     dialog_height = round((working_canvas.height / 100) * DIALOG_HEIGHT_PERCENT)
     dialog_width = round(dialog_height * DIALOG_WIDTH_RATIO)
 
-    # Create an image representing the area the 'Explorer' dialog will cover.
-    dialog_area = Image.new(
-        mode="RGBA", size=(dialog_width, dialog_height), color=DIALOG_AREA_COLOR
+    # Calculate the coordinates to place the dialog area in the center of the screen
+    h_offset = round((working_canvas.width / 2) - (dialog_width / 2))
+    v_offset = round((working_canvas.height / 2) - (dialog_height / 2))
+
+    # Blend the area the 'Explorer' dialog will cover directly onto the canvas
+    diagnostic_draw.rectangle(
+        (
+            (h_offset, v_offset),
+            (h_offset + dialog_width - 1, v_offset + dialog_height - 1),
+        ),
+        fill=DIALOG_AREA_COLOR,
     )
 
     # Place the explanatory text on the zone
-    draw_diagnostic_text(dialog_area, "[Explorers dialog area]")
+    draw_diagnostic_text(
+        diagnostic_draw, (h_offset, v_offset), "[Explorers dialog area]"
+    )
 
-    # Calculate the coordinates to place the dialog area in the center of the screen
-    h_offset = round((working_canvas.width / 2) - (dialog_area.width / 2))
-    v_offset = round((working_canvas.height / 2) - (dialog_area.height / 2))
 
-    # Place the image in the center of the canvas
-    working_canvas.paste(dialog_area, (h_offset, v_offset), dialog_area)
+def draw_aspect_ratio_zones(diagnostic_draw):
+    """Draws rectangular borders on the diagnostic image representing the areas seen in each of our aspect ratios.
+
+    Args:
+        diagnostic_draw: The PIL.ImageDraw context of the global canvas, in RGBA blending mode. The canvas must be
+            CANVAS_SIZE.
+    """
+
+    for ratio_name, zone_box, diag_color in ASPECT_ZONES:
+        # Blend only the border of the zone onto the canvas
+        diagnostic_draw.rectangle(zone_box, outline=diag_color, width=ZONE_BORDER_SIZE)
 
+        # Place the diagnostic text
+        draw_diagnostic_text(diagnostic_draw, zone_box[0], f"[{ratio_name} safe zone]")
 
-def draw_aspect_ratio_zone(working_canvas, ratio_name, ratio_specs):
-    """Draws a rectangular border on the diagnostic image representing the area seen in the given aspect ratio.
+
+def is_same_file(filename_a, filename_b):
+    """Checks whether two filenames refer to the same file on disk.
 
     Args:
-        working_canvas: The global PIL.Image canvas to draw the safe zone rectangle onto.
-        ratio_name: The name of the aspect ratio.
-        ratio_specs: Specs about the aspect ratio used to draw the rectangle and text.
+        filename_a: The first filename to compare.
+        filename_b: The second filename to compare.
 
+    Returns:
+        True if both filenames refer to the same file, otherwise False.
     """
 
-    # Calculate the real size of the area covered by the ratio
-    zone_height = working_canvas.height
-    zone_width = round(
-        (working_canvas.height / ratio_specs["height"]) * ratio_specs["width"]
-    )
+    # Resolve symlinks, and case differences on case-insensitive platforms such as Windows
+    if os.path.normcase(os.path.realpath(filename_a)) == os.path.normcase(
+        os.path.realpath(filename_b)
+    ):
+        return True
 
-    # Create a transparent image to represent the zone slightly smaller than the  final size
-    ratio_area = Image.new(
-        mode="RGBA",
-        size=(
-            zone_width - (ZONE_BORDER_SIZE * 2),
-            zone_height - (ZONE_BORDER_SIZE * 2),
-        ),
-        color=(0, 0, 0, 0),
-    )
+    # Catch hardlinks and other aliases that only the filesystem can identify, if both files already exist
+    try:
+        return os.path.samefile(filename_a, filename_b)
+    except OSError:
+        return False
 
-    # Expand the transparent image to the final size, adding in our border zone color
-    ratio_area = ImageOps.expand(
-        ratio_area, border=ZONE_BORDER_SIZE, fill=ratio_specs["diag_color"]
-    )
 
-    # Calculate the horizontal offset needed to center the area
-    h_offset = round((working_canvas.width / 2) - (ratio_area.width / 2))
+def save_image(image, image_filename):
+    """Saves an image to disk, using the encoder options for the format matching the filename's extension.
 
-    # Place the diagnostic text
-    draw_diagnostic_text(ratio_area, f"[{ratio_name} safe zone]")
+    Args:
+        image: The PIL.Image object to save.
+        image_filename: The filename to save the image as.
+    """
 
-    # Place the image on the canvas
-    working_canvas.paste(ratio_area, (h_offset, 0), ratio_area)
+    extension = os.path.splitext(image_filename)[1].lower()
+    image_format = Image.registered_extensions().get(extension)
+    image.save(image_filename, **SAVE_OPTIONS.get(image_format, {}))
 
 
-def percent_to_pixels(working_canvas, percent, mode="horizontal"):
-    """Converts from a percent value to pixel value for item padding calculations.
+def paste_image(working_canvas, image, position):
+    """Pastes an image onto the canvas, only blending it using its alpha channel if it has any transparency.
+
+    Args:
+        working_canvas: The global PIL.Image canvas to paste the image onto.
+        image: The PIL.Image object to paste.
+        position: The (x, y) coordinates to paste the top-left corner of the image at.
+    """
+
+    # Blending with a mask is much slower than a plain copy, so skip it for fully opaque images. Only the alpha band is
+    # checked, as scanning every band would take longer than the blend it avoids.
+    if image.mode in ("RGBA", "LA") and image.getchannel("A").getextrema()[0] < 255:
+        working_canvas.paste(image, position, image)
+    else:
+        working_canvas.paste(image, position)
 
-    This function is used to convert a percentage value (e.g., 5%) to a pixel value (20). It is used so that we can
-    pad logo elements from screen edges using percentage values rather than pixel values. This function can be used to
-    calculate horizontal and vertical percentages, as those differ in non-square aspect ratios.
+
+def load_background_image(image_filename, size):
+    """Loads and decodes the background image.
 
     Args:
-        working_canvas: The global PIL.Image canvas. Used to calculate the percentage->pixel ratios.
-        percent: The percent to convert into a pixel value.
-        mode: Either 'horizontal' or 'vertical'. The reference frame for the calculation.
+        image_filename: The filename of the image to use as our background.
+        size: The size of the canvas the background image will fill.
 
     Returns:
-        The pixel value that represents that percentage of either horizontal or vertical screen space.
+        The decoded PIL.Image background image.
     """
 
-    if mode not in ("horizontal", "vertical"):
-        mode = "horizontal"
+    # Load the background image. For JPEGs, let the decoder scale the image down while decoding, as long as it still
+    # covers the canvas.
+    background_image = Image.open(image_filename)
+    background_image.draft("RGB", size)
 
-    if mode == "horizontal":
-        return round((working_canvas.width / 100) * percent)
-    elif mode == "vertical":
-        return round((working_canvas.height / 100) * percent)
+    # Decode the image now rather than when it is first used
+    background_image.load()
 
+    return background_image
 
-def draw_canvas_background(working_canvas, image_filename):
+
+def draw_canvas_background(working_canvas, background_image):
     """Places the given background image into the background of our canvas.
 
     The background image will fill the canvas area, maintaining it's original aspect ration. This means that if the
@@ -179,19 +284,16 @@ def draw_canvas_background(working_canvas, image_filename):
 
     Args:
         working_canvas: The global PIL.Image canvas to draw the background onto.
-        image_filename: The filename of the image to use as our background.
+        background_image: The PIL.Image to use as our background, as returned by load_background_image.
     """
 
-    # Load the background image
-    background_image = Image.open(image_filename)
-
     # Scale the image to fill the background, maintaining its aspect ratio
     background_image = ImageOps.fit(
         background_image, working_canvas.size, centering=(0.5, 0.5)
     )
 
     # Place the image onto the canvas
-    working_canvas.paste(background_image, (0, 0), background_image)
+    paste_image(working_canvas, background_image, (0, 0))
 
 
 def draw_logo_element(
@@ -219,37 +321,45 @@ def draw_logo_element(
         scaled_height_percent: How tall to make the element in vertical canvas percent.
     """
 
+    # Look up the canvas size once, it is used throughout the placement calculations
+    canvas_width, canvas_height = working_canvas.size
+
     # Load the logo element
     logo_image = Image.open(image_filename)
 
+    # Convert other modes (e.g. palette images) to RGBA once up front, so the logo is resized with filtering and any
+    # transparency it has is used when it is pasted.
+    if logo_image.mode not in ("RGB", "RGBA"):
+        logo_image = logo_image.convert("RGBA")
+
     # Scale the logo element to a percentage of the canvas height if requested
     if scaled_height_percent:
-        target_height = round(working_canvas.height / (100 / scaled_height_percent))
-        scale_factor = target_height / logo_image.height
-        logo_image = ImageOps.scale(logo_image, scale_factor)
+        target_height = round(canvas_height / (100 / scaled_height_percent))
+        target_width = round(logo_image.width * target_height / logo_image.height)
+        logo_image = logo_image.resize(
+            (target_width, target_height), Image.Resampling.BILINEAR
+        )
+
+    # Calculate the size of one percent of the canvas in pixels, used to convert the paddings into pixel values.
+    # These differ horizontally and vertically in non-square aspect ratios.
+    h_pixels_per_percent = canvas_width / 100
+    v_pixels_per_percent = canvas_height / 100
 
     # Calculate the horizontal placement offset. Image origins are at the top-left corner.
     if horizontal_align not in ("left", "right", "center"):
         horizontal_align = "left"
 
     if horizontal_align == "left":
-        h_offset = 0 + percent_to_pixels(
-            working_canvas, padding_left, mode="horizontal"
-        )
+        h_offset = round(h_pixels_per_percent * padding_left)
     elif horizontal_align == "center":
         h_offset = round(
-            (
-                (canvas.width / 2)
-                - (logo_image.width / 2)
-                + percent_to_pixels(working_canvas, padding_left, mode="horizontal")
-                - percent_to_pixels(working_canvas, padding_right, mode="horizontal")
-            )
+            (canvas_width / 2)
+            - (logo_image.width / 2)
+            + h_pixels_per_percent * (padding_left - padding_right)
         )
     elif horizontal_align == "right":
         h_offset = round(
-            working_canvas.width
-            - logo_image.width
-            + percent_to_pixels(working_canvas, padding_right, mode="horizontal")
+            canvas_width - logo_image.width + h_pixels_per_percent * padding_right
         )
 
     # Calculate the vertical offset
@@ -257,25 +367,29 @@ def draw_logo_element(
         vertical_align = "top"
 
     if vertical_align == "top":
-        v_offset = 0 + percent_to_pixels(working_canvas, padding_top, mode="vertical")
+        v_offset = round(v_pixels_per_percent * padding_top)
     elif vertical_align == "middle":
         v_offset = round(
-            ((canvas.height / 2) - (logo_image.height / 2))
-            + percent_to_pixels(working_canvas, padding_top, mode="vertical")
-            - percent_to_pixels(working_canvas, padding_bottom, mode="vertical")
+            (canvas_height / 2)
+            - (logo_image.height / 2)
+            + v_pixels_per_percent * (padding_top - padding_bottom)
         )
     elif vertical_align == "bottom":
         v_offset = round(
-            working_canvas.height
-            - logo_image.height
-            - percent_to_pixels(working_canvas, padding_bottom, mode="vertical")
+            canvas_height - logo_image.height - v_pixels_per_percent * padding_bottom
         )
 
     # Place the image element
-    working_canvas.paste(logo_image, (h_offset, v_offset), logo_image)
+    paste_image(working_canvas, logo_image, (h_offset, v_offset))
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Generates the background images.
+
+    Args:
+        argv: The command line arguments to parse. Defaults to the arguments the script was run with.
+    """
+
     # Configure argparse
     parser = argparse.ArgumentParser(
         prog="StartUp Age Background Generator",
@@ -311,47 +425,76 @@ if __name__ == "__main__":
         help="The unscaled output image to be generated with diagnostic overlays applied.",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    # Configure logging
+    # Configure the log level on every run, so the diagnostics flag applies when main() is called repeatedly. Log
+    # handlers are left to the script entry point, or to the application importing us.
     if args.diagnostics:
-        logging.basicConfig(level=logging.DEBUG, format="[%(levelname)s] %(message)s")
+        logging.getLogger().setLevel(logging.DEBUG)
     else:
-        logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
-
-    # Set up our canvas
-    canvas = Image.new(mode="RGB", size=CANVAS_SIZE)
-
-    # Place the background image
-    draw_canvas_background(canvas, args.image_filename)
-
-    # Place the Cyan logo centered on the bottom edge.
-    draw_logo_element(
-        canvas,
-        CYAN_LOGO_FILE,
-        horizontal_align="center",
-        vertical_align="bottom",
-        scaled_height_percent=10,
-        padding_bottom=3.5,
-    )
+        logging.getLogger().setLevel(logging.INFO)
+
+    # The same worker threads are used to decode the background image and to save the results
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Start decoding the background image on a worker thread, as Pillow releases the GIL while decoding. The canvas
+        # is set up in the meantime.
+        background_loaded = executor.submit(
+            load_background_image, args.image_filename, CANVAS_SIZE
+        )
+
+        # Set up our canvas
+        canvas = Image.new(mode="RGB", size=CANVAS_SIZE)
 
-    # Save the result
-    canvas.save(args.output_filename)
-    logging.info(f"Saved unscaled image as {args.texture_filename}")
+        # Place the background image
+        draw_canvas_background(canvas, background_loaded.result())
 
-    # Stetch the image to the desired texture size
-    texture = canvas.resize(TEXTURE_SIZE)
-    texture.save(args.texture_filename)
+        # Place the Cyan logo centered on the bottom edge.
+        draw_logo_element(
+            canvas,
+            CYAN_LOGO_FILE,
+            horizontal_align="center",
+            vertical_align="bottom",
+            scaled_height_percent=10,
+            padding_bottom=3.5,
+        )
+
+        # Stetch the image to the desired texture size. The texture must hold the canvas distorted to its width (it is
+        # squashed back to the canvas aspect ratio in the game), so it can't be rendered at the texture size directly.
+        # Only the width changes, so Pillow only runs a horizontal resampling pass. The stretch is slight enough that a
+        # bilinear filter looks the same as the default bicubic one, and it is faster.
+        texture = canvas.resize(TEXTURE_SIZE, Image.Resampling.BILINEAR)
+
+        # Save the unscaled and texture-scaled images in parallel, as Pillow releases the GIL while encoding. If both
+        # are the same file, save them one after the other so that the texture is the one left on disk. Both saves
+        # must be finished before the diagnostic overlays are drawn onto the canvas.
+        same_file = is_same_file(args.output_filename, args.texture_filename)
+        output_saved = executor.submit(save_image, canvas, args.output_filename)
+        if same_file:
+            output_saved.result()
+        texture_saved = executor.submit(save_image, texture, args.texture_filename)
+
+    output_saved.result()
+    logging.info(f"Saved unscaled image as {args.output_filename}")
+    texture_saved.result()
     logging.info(f"Saved texture-scaled image as {args.texture_filename}")
 
     if args.diagnostics:
+        # All of the diagnostic overlays are blended onto the canvas through the same drawing context
+        diagnostic_draw = ImageDraw.Draw(canvas, "RGBA")
+
         # Place the dialog zone
-        draw_dialog_zone(canvas)
+        draw_dialog_zone(canvas, diagnostic_draw)
 
         # Place the safe zones
-        for ratio in ASPECT_RATIOS.keys():
-            draw_aspect_ratio_zone(canvas, ratio, ASPECT_RATIOS[ratio])
+        draw_aspect_ratio_zones(diagnostic_draw)
 
         # Save the diagnostics file
-        canvas.save(args.diagnostic_filename)
+        save_image(canvas, args.diagnostic_filename)
         logging.info(f"Saved diagnostic image as {args.diagnostic_filename}")
+
+
+if __name__ == "__main__":
+    # Configure logging
+    logging.basicConfig(format="[%(levelname)s] %(message)s")
+
+    main()